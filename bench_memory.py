@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Reports how much memory loading the ASTs of script files takes, as peak RSS per MB of
+# uncompressed pickle data. All loaded ASTs are kept alive until the end, as decompiling a
+# whole game would.
+#
+#   python bench_memory.py file [file ...]
+
+import sys
+from os import path
+
+import unrpyc
+
+
+def peak_rss():
+    # Peak resident set size of this process in bytes
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python bench_memory.py file [file ...]")
+        return
+
+    files = []
+    for i in sys.argv[1:]:
+        if path.isdir(i):
+            files.extend(unrpyc.script_files(i))
+        else:
+            files.append(i)
+
+    baseline = peak_rss()
+    pickled = 0
+    asts = []
+    for filename in files:
+        with open(filename, 'rb') as in_file:
+            raw_contents = unrpyc.read_pickle(in_file)
+        pickled += len(raw_contents)
+        data, stmts = unrpyc.revertable_switch(raw_contents)
+        asts.append(stmts)
+        del raw_contents
+    peak = peak_rss()
+
+    mb = 1024.0 * 1024.0
+    if not pickled:
+        print("No pickle data was loaded.")
+        return
+    print("Loaded %d file%s, %.1f MB of uncompressed pickle data" % (len(files), 's' if len(files) > 1 else '', pickled / mb))
+    print("Peak RSS: %.1f MB (%.1f MB before loading)" % (peak / mb, baseline / mb))
+    print("Peak RSS per MB of pickle: %.2f MB (%.2f MB excluding the baseline)" % (peak / float(pickled), (peak - baseline) / float(pickled)))
+
+if __name__ == '__main__':
+    main()
@@ -31,15 +31,42 @@
 # Then, there's 0 or more steps of decrypting the data in that slot. This ends up often
 # being layers of base64, string-escape, hex-encoding, zlib-compression, etc.
 # We handle this by just trying these by checking if they fit.
+# For large files both steps can be run in a process pool. The extractors then work directly
+# on a memory map of the file in each worker, and store the slot they extracted in a scratch
+# directory. When that gives several different slots, workers decrypt each of them up to the
+# point where it could be a pickle and store the result there as well, so the main process
+# only has to unpickle it. Data is shared through these files rather than sent over pipes,
+# although the main process still reads each slot so it can tell which ones are the same.
+# The results are handled in the same order as when running serially, so the diagnosis stays
+# the same.
 
 import os
 import zlib
+import shutil
+import tempfile
+import mmap
 import struct
 import base64
+import pickletools
 from collections import Counter
 from decompiler import magic
 import unrpyc
 
+try:
+    from multiprocessing import Pool, Event
+except ImportError:
+    # Some Ren'Py distributions ship without multiprocessing support
+    Pool = None
+
+# Files smaller than this aren't worth distributing over processes
+PARALLEL_MIN_SIZE = 1024 * 1024
+
+# The process pool is shared between all files, see start_pool
+pool = None
+cancel_event = None
+# in pool workers, set when the remaining work is no longer needed
+cancelled = None
+
 
 # Extractors are simple functions of (fobj, slotno) -> bytes
 # They raise ValueError if they fail
@@ -56,6 +83,14 @@ def decryptor(f):
     return f
 
 
+def file_contents(f):
+    # Returns the whole file. Memory maps are used as is, so they don't get copied
+    if isinstance(f, mmap.mmap):
+        return f
+    f.seek(0)
+    return f.read()
+
+
 # Add game-specific custom extraction / decryption logic here
 
 # End of custom extraction/decryption logic
@@ -66,8 +101,7 @@ def extract_slot_rpyc(f, slot):
     """
     Slot extractor for a file that's in the actual rpyc format
     """
-    f.seek(0)
-    data = f.read()
+    data = file_contents(f)
     if data[:10] != b'RENPY RPC2':
         raise ValueError("Incorrect Header")
 
@@ -101,8 +135,7 @@ def extract_slot_legacy(f, slot):
     if slot != 1:
         raise ValueError("Legacy format only supports 1 slot")
 
-    f.seek(0)
-    data = f.read()
+    data = file_contents(f)
 
     try:
         data = zlib.decompress(data)
@@ -116,8 +149,7 @@ def extract_slot_headerscan(f, slot):
     """
     Slot extractor for things that changed the magic and so moved the header around.
     """
-    f.seek(0)
-    data = f.read()
+    data = file_contents(f)
 
     position = 0
     while position + 36 < len(data):
@@ -155,8 +187,7 @@ def extract_slot_zlibscan(f, slot):
     Slot extractor for things that fucked with the header structure to the point where it's easier
     to just not bother with it and instead we just look for valid zlib chunks directly.
     """
-    f.seek(0)
-    data = f.read()
+    data = file_contents(f)
 
     start_positions = []
 
@@ -277,19 +308,136 @@ def assert_is_normal_rpyc(f):
         return uncompressed
 
 
-def read_ast(f):
+def run_extractor(f, index):
+    try:
+        return True, EXTRACTORS[index](f, 1)
+    except ValueError as e:
+        return False, str(e)
+
+def run_extractor_mapped(task):
+    # Process pool version of run_extractor. This runs the extractor directly on a memory map
+    # of the file, and returns the name of the file the slot was stored in.
+    filename, index, scratch = task
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            success, result = run_extractor(buf, index)
+        finally:
+            buf.close()
+    if not success:
+        return False, result
+
+    slot_filename = os.path.join(scratch, "slot%d" % index)
+    with open(slot_filename, 'wb') as f:
+        f.write(result)
+    return True, slot_filename
+
+def run_decrypt(raw_data):
+    try:
+        return True, try_decrypt_section(raw_data)
+    except ValueError as e:
+        return False, str(e)
+
+def find_decrypt_chain(slot_filename):
+    # Process pool version of run_decrypt. This only decrypts the slot until it could be a
+    # pickle, and stores the result for the main process to unpickle.
+    with open(slot_filename, 'rb') as f:
+        raw_data = f.read()
+    try:
+        result, raw_data, applied, layers = peel_layers(raw_data, may_be_pickle)
+    except ValueError as e:
+        return False, str(e)
+
+    if applied:
+        slot_filename += ".decrypted"
+        with open(slot_filename, 'wb') as f:
+            f.write(raw_data)
+    return True, (slot_filename, applied, layers)
+
+def load_decrypted(slot_filename, applied, layers):
+    # Unpickles what find_decrypt_chain found, continuing like try_decrypt_section in case it
+    # didn't unpickle after all.
+    with open(slot_filename, 'rb') as f:
+        raw_data = f.read()
+
+    diagnosis = ["performed a round of %s" % name for name in applied]
+    try:
+        (data, stmts), raw_data, more, layers = peel_layers(raw_data, load_section, layers)
+    except ValueError as e:
+        return False, "\n".join(diagnosis + [str(e)])
+    return True, (data, stmts, diagnosis + ["performed a round of %s" % name for name in more])
+
+def init_worker(event):
+    global cancelled
+    cancelled = event
+
+def start_pool(jobs):
+    # Starts the process pool used by read_ast for large files. As the workers are forked on
+    # POSIX, this has to be called before any other threads are started.
+    global pool, cancel_event
+    if Pool is not None and pool is None:
+        cancel_event = Event()
+        pool = Pool(jobs, init_worker, (cancel_event,))
+
+def cancel_pending(results):
+    # Makes the workers give up on the remaining tasks, and waits for them to do so
+    cancel_event.set()
+    try:
+        for _ in results:
+            pass
+    finally:
+        cancel_event.clear()
+
+def close_pool():
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
+
+def read_ast(f, filename=None):
+    # When the pool was started, large files are deobfuscated in parallel. This needs the
+    # filename, as the workers map the file themselves.
+    if pool is None or filename is None or os.path.getsize(filename) < PARALLEL_MIN_SIZE:
+        return read_ast_with(f)
+
+    scratch = tempfile.mkdtemp(prefix="unrpyc-")
+    try:
+        return read_ast_with(f, pool, filename, scratch)
+    except ValueError:
+        raise
+    except Exception:
+        # Tasks of this file might still be running, don't let them hold up the next one.
+        # Later files are handled serially, as a new pool can't be forked safely anymore.
+        close_pool()
+        raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def read_ast_with(f, pool=None, filename=None, scratch=None):
     diagnosis = ["Attempting to deobfuscate file:"]
 
     raw_datas = set()
+    # slot contents -> the file they're stored in, when running in the pool
+    slot_filenames = {}
 
-    for extractor in EXTRACTORS:
-        try:
-            data = extractor(f, 1)
-        except ValueError as e:
-            diagnosis.append("strategy %s failed: %s" % (extractor.__name__, e.message))
+    if pool is None:
+        results = (run_extractor(f, i) for i in range(len(EXTRACTORS)))
+    else:
+        results = pool.imap(run_extractor_mapped, [(filename, i, scratch) for i in range(len(EXTRACTORS))])
+
+    for extractor, (success, result) in zip(EXTRACTORS, results):
+        if not success:
+            diagnosis.append("strategy %s failed: %s" % (extractor.__name__, result))
+            continue
+
+        diagnosis.append("strategy %s success" % extractor.__name__)
+        if pool is None:
+            raw_datas.add(result)
         else:
-            diagnosis.append("strategy %s success" % extractor.__name__)
-            raw_datas.add(data)
+            with open(result, 'rb') as slot_file:
+                raw_data = slot_file.read()
+            raw_datas.add(raw_data)
+            slot_filenames[raw_data] = result
 
     if not raw_datas:
         diagnosis.append("All strategies failed. Unable to extract data")
@@ -298,34 +446,69 @@ def read_ast(f):
     if len(raw_datas) != 1:
         diagnosis.append("Strategies produced different results. Trying all options")
 
-    data = None
+    raw_datas = list(raw_datas)
+    if len(raw_datas) == 1:
+        # nothing to run in parallel, decrypting it here avoids passing it around
+        pool = None
+    if pool is not None:
+        # results arrive in order, so the first success is the same one a serial run would find
+        chains = pool.imap(find_decrypt_chain, [slot_filenames[raw_data] for raw_data in raw_datas])
+
     for raw_data in raw_datas:
-        try:
-            data, stmts, d = try_decrypt_section(raw_data)
-        except ValueError as e:
-            diagnosis.append(e.message)
+        if pool is None:
+            success, result = run_decrypt(raw_data)
         else:
-            diagnosis.extend(d)
-            with unrpyc.printlock:
-                print("\n".join(diagnosis))
-            return stmts
+            success, result = next(chains)
+            if success:
+                # if this doesn't unpickle after all, the remaining options are tried here
+                cancel_pending(chains)
+                pool = None
+                success, result = load_decrypted(*result)
+
+        if not success:
+            diagnosis.append(result)
+            continue
+
+        data, stmts, d = result
+        diagnosis.extend(d)
+        with unrpyc.printlock:
+            print("\n".join(diagnosis))
+        return stmts
 
     diagnosis.append("All strategies failed. Unable to deobfuscate data")
     raise ValueError("\n".join(diagnosis))
 
 
-def try_decrypt_section(raw_data):
-    diagnosis = []
+# Every pickle starts with an opcode and contains a STOP opcode
+PICKLE_OPCODES = frozenset(op.code if isinstance(op.code, bytes) else op.code.encode('latin-1')
+                           for op in pickletools.opcodes)
+
+def may_be_pickle(raw_data):
+    # Cheap check that rules out most data that can't be unpickled, but never data that can be
+    return raw_data[:1] in PICKLE_OPCODES and b"." in raw_data
+
+def load_section(raw_data):
+    try:
+        return magic.safe_loads(raw_data, unrpyc.class_factory, {"_ast", "collections"})
+    except Exception:
+        return None
+
+def peel_layers(raw_data, loads, layers=0):
+    """
+    Removes layers of encryption from raw_data until loads accepts it. Returns what loads
+    returned, the decrypted data, the names of the decryptors used and the amount of layers
+    tried. Raises ValueError with the diagnosis if this doesn't work out.
+    """
+    applied = []
 
-    layers = 0
     while layers < 10:
         # can we load it yet?
-        try:
-            data, stmts = magic.safe_loads(raw_data, unrpyc.class_factory, {"_ast", "collections"})
-        except Exception:
-            pass
-        else:
-            return data, stmts, diagnosis
+        result = loads(raw_data)
+        if result:
+            return result, raw_data, applied, layers
+
+        if cancelled is not None and cancelled.is_set():
+            raise ValueError("Cancelled")
 
         layers += 1
         count = Counter(raw_data)
@@ -336,10 +519,16 @@ def try_decrypt_section(raw_data):
                 continue
             else:
                 raw_data = newdata
-                diagnosis.append("performed a round of %s" % decryptor.__name__)
+                applied.append(decryptor.__name__)
                 break
         else:
             break
 
+    diagnosis = ["performed a round of %s" % name for name in applied]
     diagnosis.append("Did not know how to decrypt data.")
     raise ValueError("\n".join(diagnosis))
+
+
+def try_decrypt_section(raw_data):
+    (data, stmts), raw_data, applied, layers = peel_layers(raw_data, load_section)
+    return data, stmts, ["performed a round of %s" % name for name in applied]
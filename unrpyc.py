@@ -21,6 +21,7 @@
 # SOFTWARE.
 import argparse
 import sys
+import os
 from os import path, walk
 import glob
 import codecs
@@ -28,9 +29,20 @@ import itertools
 import traceback
 import struct
 import inspect
+import io
+import hashlib
+import json
+import numbers
+import threading
 from operator import itemgetter
+from collections import Counter, OrderedDict
+try:
+    from collections.abc import Mapping, Set
+except ImportError:
+    from collections import Mapping, Set
 sys.path.append('..')
 PY2 = sys.version_info < (3, 0)
+string_types = (str, unicode) if PY2 else (str, bytes)
 
 import renpy.object
 
@@ -58,20 +70,147 @@ class Lock:
     def release(self):
         pass
 
+class Prefetcher(object):
+    """
+    Reads upcoming input files on background threads, so the disk is busy while the
+    current file is being unpickled and decompiled. At most `depth` files are buffered
+    at a time, using no more than `budget` bytes. A file larger than the budget is
+    only read once nothing else is buffered.
+
+    Files are expected to be consumed in the order they were passed in.
+    """
+    def __init__(self, files, depth=4, budget=256 * 1024 * 1024, threads=2):
+        self.files = []
+        self.sizes = {}
+        for filename, size in files:
+            if filename not in self.sizes:
+                self.files.append(filename)
+                self.sizes[filename] = size
+        self.depth = depth
+        self.budget = budget
+
+        # filename -> None while being read, the contents (or the exception) once done
+        self.pending = {}
+        self.position = 0
+        self.buffered = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        for _ in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def _can_schedule(self):
+        if len(self.pending) >= self.depth:
+            return False
+        size = self.sizes[self.files[self.position]]
+        return not self.pending or self.buffered + size <= self.budget
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while (not self.closed and self.position < len(self.files)
+                       and not self._can_schedule()):
+                    self.condition.wait()
+                if self.closed or self.position >= len(self.files):
+                    return
+                filename = self.files[self.position]
+                self.position += 1
+                self.pending[filename] = None
+                self.buffered += self.sizes[filename]
+
+            try:
+                with open(filename, 'rb') as in_file:
+                    contents = in_file.read()
+            except Exception as e:
+                contents = e
+
+            with self.condition:
+                if filename in self.pending:
+                    self.pending[filename] = contents
+                else:
+                    # discarded while we were reading it
+                    self.buffered -= self.sizes[filename]
+                self.condition.notify_all()
+
+    def _skip(self, filename):
+        # the consumer got here first, make sure we don't read it anymore
+        if self.position < len(self.files) and self.files[self.position] == filename:
+            self.position += 1
+
+    def take(self, filename):
+        """
+        Returns the contents of filename, waiting for it if it is still being read.
+        Returns None if the file wasn't prefetched, in which case the caller reads it itself.
+        """
+        with self.condition:
+            if filename not in self.pending:
+                self._skip(filename)
+                return None
+
+            while self.pending.get(filename, False) is None:
+                self.condition.wait()
+            if filename not in self.pending:
+                return None
+            contents = self.pending.pop(filename)
+            self.buffered -= self.sizes[filename]
+            self.condition.notify_all()
+
+        if isinstance(contents, Exception):
+            raise contents
+        return contents
+
+    def discard(self, filename):
+        # Frees the buffer of a file that is not going to be taken
+        with self.condition:
+            if filename not in self.pending:
+                self._skip(filename)
+            elif self.pending.pop(filename) is not None:
+                self.buffered -= self.sizes[filename]
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
 import decompiler
 from decompiler import magic, astdump, translate, util
 
+# Large scripts contain hundreds of thousands of expressions, so PyExpr uses __slots__ and
+# filenames are shared to keep memory usage down. PyExpr is dumped as a string, but PyCode keeps
+# its __dict__ as astdump prints generic objects from their attributes.
+filenames = {}
+
+def intern_filename(filename):
+    return filenames.setdefault(filename, filename)
+
+def set_slots(self, state):
+    # pickles of objects with __slots__ store their attributes as (dict_state, slot_state)
+    if isinstance(state, tuple):
+        dict_state, slot_state = state
+        state = dict(dict_state or {}, **(slot_state or {}))
+    for key, value in state.items():
+        setattr(self, key, value)
+
 # special definitions for special classes
 if(not PY2):
     class PyExpr(magic.FakeStrict, str):
         __module__ = "renpy.ast"
+        __slots__ = ('filename', 'linenumber', 'py')
+
         def __new__(cls, s, filename, linenumber, py=None):
             self = str.__new__(cls, s)
-            self.filename = filename
+            self.filename = intern_filename(filename)
             self.linenumber = linenumber
             self.py = py
             return self
 
+        def __setstate__(self, state):
+            set_slots(self, state)
+            self.filename = intern_filename(self.filename)
+
         def __getnewargs__(self):
             if self.py is not None:
                 return str(self), self.filename, self.linenumber, self.py
@@ -80,13 +219,19 @@ if(not PY2):
 else:
     class PyExpr(magic.FakeStrict, unicode):
         __module__ = "renpy.ast"
+        __slots__ = ('filename', 'linenumber', 'py')
+
         def __new__(cls, s, filename, linenumber, py=None):
             self = unicode.__new__(cls, s)
-            self.filename = filename
+            self.filename = intern_filename(filename)
             self.linenumber = linenumber
             self.py = py
             return self
 
+        def __setstate__(self, state):
+            set_slots(self, state)
+            self.filename = intern_filename(self.filename)
+
         def __getnewargs__(self):
             if self.py is not None:
                 return unicode(self), self.filename, self.linenumber, self.py
@@ -102,19 +247,27 @@ class PyCode(magic.FakeStrict):
         else:
             (_, self.source, self.location, self.mode, self.py) = state
         self.bytecode = None
+        if isinstance(self.location, tuple) and self.location:
+            self.location = (intern_filename(self.location[0]),) + self.location[1:]
 
 class RevertableList(magic.FakeStrict, list):
     __module__ = "renpy.revertable"
+    __slots__ = ()
+
     def __new__(cls):
         return list.__new__(cls)
 
 class RevertableDict(magic.FakeStrict, dict):
     __module__ = "renpy.revertable"
+    __slots__ = ()
+
     def __new__(cls):
         return dict.__new__(cls)
 
 class RevertableSet(magic.FakeStrict, set):
     __module__ = "renpy.revertable"
+    __slots__ = ()
+
     def __new__(cls):
         return set.__new__(cls)
 
@@ -158,15 +311,22 @@ def revertable_switch(raw_dat):
     return data, stmts
 
 printlock = Lock()
+prefetcher = None
 
 # needs class_factory
 import deobfuscate
 
 # API
 
-def read_ast_from_file(in_file):
+def open_input(input_filename):
+    # Use the prefetched contents of the file if they're available
+    contents = prefetcher.take(input_filename) if prefetcher is not None else None
+    if contents is None:
+        return open(input_filename, 'rb')
+    return io.BytesIO(contents)
+
+def read_pickle_from_file(in_file):
     # .rpyc files are just zlib compressed pickles of a tuple of some data and the actual AST of the file
-    global class_factory
     raw_contents = in_file.read()
     if raw_contents[:len(RPYC_Header)] != RPYC_Header:
             if slot != 1:
@@ -193,9 +353,26 @@ def read_ast_from_file(in_file):
         raw_contents = raw_contents[1].decode('zlib')
     else:
         raw_contents = codecs.decode(raw_contents, encoding="zlib")
-    data, stmts = revertable_switch(raw_contents)
+    return raw_contents
+
+def read_ast_from_file(in_file):
+    global class_factory
+    data, stmts = revertable_switch(read_pickle_from_file(in_file))
     return stmts
 
+def read_pickle(in_file):
+    # Returns the uncompressed pickle of the AST, using Ren'Py's own loader when it has a usable one
+    if (not hasattr(script.Script, "read_rpyc_data") or inspect.ismethod(script.Script.read_rpyc_data)):
+        return read_pickle_from_file(in_file)
+    return script.Script.read_rpyc_data(object, in_file, 1)
+
+def read_ast(in_file, try_harder=False, filename=None):
+    global class_factory
+    if try_harder:
+        return deobfuscate.read_ast(in_file, filename)
+    data, ast = revertable_switch(read_pickle(in_file))
+    return ast
+
 
 def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python=False,
                    comparable=False, no_pyexpr=False, translator=None, tag_outside_block=False,
@@ -216,16 +393,8 @@ def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python
             print("Output file already exists. Pass --clobber to overwrite.")
             return False # Don't stop decompiling if one file already exists
 
-    with open(input_filename, 'rb') as in_file:
-        global class_factory
-        if try_harder:
-            ast = deobfuscate.read_ast(in_file)
-        else:
-            if (not hasattr(script.Script, "read_rpyc_data") or inspect.ismethod(script.Script.read_rpyc_data)):
-                ast = read_ast_from_file(in_file)
-            else:
-                raw_contents = script.Script.read_rpyc_data(object, in_file, 1)
-                data, ast = revertable_switch(raw_contents)
+    with open_input(input_filename) as in_file:
+        ast = read_ast(in_file, try_harder, input_filename)
 
     with codecs.open(out_filename, 'w', encoding='utf-8') as out_file:
         if dump:
@@ -238,11 +407,216 @@ def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python
 
     return True
 
+# Attributes that differ between two builds even when the code they belong to is the same.
+# next and statement_start point at other statements, which are hashed on their own.
+VOLATILE_ATTRIBUTES = frozenset(("filename", "linenumber", "lineno", "col_offset", "end_lineno",
+                                 "end_col_offset", "location", "loc", "serial", "next",
+                                 "statement_start", "py", "bytecode"))
+
+# file digest -> OrderedDict of block key -> block digest, see --diff-cache
+block_cache = {}
+# the entries of block_cache for files seen in this run, which are the ones written back
+used_blocks = {}
+# bump this when the block keys or digests change, so old caches are ignored
+BLOCK_CACHE_VERSION = 2
+
+def attribute_names(obj):
+    names = list(getattr(obj, "__dict__", ()))
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        names.extend((slots,) if isinstance(slots, string_types) else slots)
+    return sorted(frozenset(names).difference(("__dict__", "__weakref__")))
+
+def structure_digest(obj, digests):
+    """
+    Returns a digest of obj and everything it references, leaving out line numbers and the other
+    VOLATILE_ATTRIBUTES as well as the names Ren'Py generates for anonymous statements.
+    Unlike astdump this doesn't modify obj. digests caches the digest of every object by id.
+    """
+    if isinstance(obj, string_types):
+        # this includes PyExpr, so its line number is left out as well
+        return hashlib.sha1(obj if isinstance(obj, bytes) else obj.encode('utf-8')).digest()
+    if obj is None or isinstance(obj, numbers.Number):
+        return hashlib.sha1(repr(obj).encode('utf-8')).digest()
+
+    ident = id(obj)
+    if ident in digests:
+        return digests[ident]
+    digests[ident] = b"cycle"
+
+    hasher = hashlib.sha1(type(obj).__name__.encode('utf-8'))
+    if isinstance(obj, Mapping):
+        for key, value in sorted((structure_digest(key, digests), structure_digest(value, digests))
+                                 for key, value in obj.items()):
+            hasher.update(key)
+            hasher.update(value)
+    elif isinstance(obj, Set):
+        for item in sorted(structure_digest(item, digests) for item in obj):
+            hasher.update(item)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            hasher.update(structure_digest(item, digests))
+
+    for name in attribute_names(obj):
+        value = getattr(obj, name, None)
+        if name in VOLATILE_ATTRIBUTES or (name == "name" and not isinstance(value, string_types)):
+            continue
+        hasher.update(name.encode('utf-8'))
+        hasher.update(structure_digest(value, digests))
+
+    digests[ident] = hasher.digest()
+    return digests[ident]
+
+def block_name(node):
+    # Ren'Py gives anonymous statements a (filename, timestamp, serial) name that changes with
+    # every build, so only string names (labels) are used.
+    name = getattr(node, "name", None)
+    if isinstance(name, string_types):
+        return name
+
+    name = getattr(node, "varname", None) or getattr(node, "imgname", None)
+    if name is None and hasattr(node, "screen"):
+        name = getattr(node.screen, "name", None)
+    if isinstance(name, list):
+        name = tuple(name)
+    return name
+
+def hash_blocks(ast):
+    """
+    Hashes every top-level statement of ast. Returns an OrderedDict of block key -> digest and
+    a dict of block key -> node.
+
+    A block key looks like ("Init", "Screen", "main_menu", 1). Anonymous blocks, like init
+    python blocks, have None as their name. The last item numbers blocks that share the rest of
+    their key in the order they appear, so an edited anonymous block keeps its key.
+    """
+    digests = OrderedDict()
+    nodes = {}
+    seen = Counter()
+    cache = {}
+    for node in ast:
+        inner = node
+        if type(node).__name__ == "Init" and len(node.block) == 1:
+            inner = node.block[0]
+
+        digest = hashlib.sha1(structure_digest(node, cache)).hexdigest()
+        key = (type(node).__name__, type(inner).__name__, block_name(inner))
+        seen[key] += 1
+        key += (seen[key],)
+
+        digests[key] = digest
+        nodes[key] = node
+    return digests, nodes
+
+def describe_block(key):
+    kind, inner, name, index = key
+    if name is None:
+        description = "anonymous %s block" % inner.lower()
+    else:
+        if isinstance(name, tuple):
+            name = " ".join(str(i) for i in name)
+        description = "%s %s" % (inner.lower(), name)
+    if kind != inner:
+        description = "%s %s" % (kind.lower(), description)
+    return description if index == 1 else "%s (#%d)" % (description, index)
+
+def load_blocks(contents, filename, try_harder=False, use_cache=True):
+    # Returns the block digests and nodes of a script file, see hash_blocks. When the digests
+    # are found in block_cache, the file isn't unpickled at all and the nodes are None.
+    file_digest = hashlib.sha1(contents).hexdigest()
+    if use_cache and file_digest in block_cache:
+        used_blocks[file_digest] = block_cache[file_digest]
+        return block_cache[file_digest], None
+
+    digests, nodes = hash_blocks(read_ast(io.BytesIO(contents), try_harder, filename))
+    block_cache[file_digest] = used_blocks[file_digest] = digests
+    return digests, nodes
+
+def read_block_cache(filename):
+    with open(filename, 'r') as cache_file:
+        cache = json.load(cache_file)
+    if not isinstance(cache, dict) or cache.get("version") != BLOCK_CACHE_VERSION:
+        print("Ignoring %s, it was written by a different version." % filename)
+        return
+    for file_digest, blocks in cache["files"].items():
+        block_cache[file_digest] = OrderedDict(
+            (tuple(tuple(i) if isinstance(i, list) else i for i in key), digest) for key, digest in blocks)
+
+def write_block_cache(filename):
+    with open(filename, 'w') as cache_file:
+        json.dump({"version": BLOCK_CACHE_VERSION,
+                   "files": dict((file_digest, list(digests.items())) for file_digest, digests in used_blocks.items())},
+                  cache_file)
+
+def remove_stale_output(out_filename):
+    # A .rpydiff from an earlier run would claim that an unchanged file changed
+    if path.exists(out_filename):
+        os.remove(out_filename)
+
+def diff_rpyc(old_filename, new_filename, overwrite=False, decompile_python=False, translator=None,
+              tag_outside_block=False, init_offset=False, try_harder=False):
+    # Decompiles only the top-level blocks of new_filename that differ from old_filename.
+    # old_filename is None for files that are new in this build.
+    filepath, ext = path.splitext(new_filename)
+    out_filename = filepath + ".rpydiff"
+
+    with open(new_filename, 'rb') as in_file:
+        new_contents = in_file.read()
+    old_contents = None
+    if old_filename is not None:
+        with open(old_filename, 'rb') as in_file:
+            old_contents = in_file.read()
+
+    if new_contents == old_contents:
+        # identical files don't need to be unpickled at all
+        with printlock:
+            print("Unchanged %s" % new_filename)
+        remove_stale_output(out_filename)
+        return True
+
+    with printlock:
+        print("Diffing %s..." % new_filename)
+
+    old_digests = OrderedDict()
+    if old_contents is not None:
+        old_digests, old_nodes = load_blocks(old_contents, old_filename, try_harder)
+    new_digests, new_nodes = load_blocks(new_contents, new_filename, try_harder)
+
+    changed = [key for key, digest in new_digests.items() if old_digests.get(key) != digest]
+    removed = [key for key in old_digests if key not in new_digests]
+
+    if not changed and not removed:
+        with printlock:
+            print("No structural changes in %s" % new_filename)
+        remove_stale_output(out_filename)
+        return True
+
+    with printlock:
+        print("Writing changes of %s to %s..." % (new_filename, out_filename))
+
+        if not overwrite and path.exists(out_filename):
+            print("Output file already exists. Pass --clobber to overwrite.")
+            return False
+
+    if new_nodes is None:
+        # only the digests were cached, we need the actual statements to decompile them
+        new_digests, new_nodes = load_blocks(new_contents, new_filename, try_harder, use_cache=False)
+
+    with codecs.open(out_filename, 'w', encoding='utf-8') as out_file:
+        for key in removed:
+            out_file.write(u"# Removed: %s\n" % describe_block(key))
+        if changed:
+            decompiler.pprint(out_file, [new_nodes[key] for key in changed], decompile_python=decompile_python,
+                                            printlock=printlock, translator=translator,
+                                            tag_outside_block=tag_outside_block, init_offset=init_offset)
+
+    return True
+
 def extract_translations(input_filename, language):
     with printlock:
         print("Extracting translations from %s..." % input_filename)
 
-    with open(input_filename, 'rb') as in_file:
+    with open_input(input_filename) as in_file:
         ast = read_ast_from_file(in_file)
 
     translator = translate.Translator(language, True)
@@ -250,17 +624,20 @@ def extract_translations(input_filename, language):
     # we pickle and unpickle this manually because the regular unpickler will choke on it
     return magic.safe_dumps(translator.dialogue), translator.strings
 
+def load_translator(args):
+    if args.translation_file is None:
+        return None
+    translator = translate.Translator(None)
+    translator.language, translator.dialogue, translator.strings = magic.loads(args.translations, class_factory)
+    return translator
+
 def worker(t):
     (args, filename, filesize) = t
     try:
         if args.write_translation_file:
             return extract_translations(filename, args.language)
         else:
-            if args.translation_file is not None:
-                translator = translate.Translator(None)
-                translator.language, translator.dialogue, translator.strings = magic.loads(args.translations, class_factory)
-            else:
-                translator = None
+            translator = load_translator(args)
             return decompile_rpyc(filename, args.clobber, args.dump, decompile_python=args.decompile_python,
                                   no_pyexpr=args.no_pyexpr, comparable=args.comparable, translator=translator,
                                   tag_outside_block=args.tag_outside_block, init_offset=args.init_offset, try_harder=args.try_harder)
@@ -269,6 +646,28 @@ def worker(t):
             print("Error while decompiling %s:" % filename)
             print(traceback.format_exc())
         return False
+    finally:
+        if prefetcher is not None:
+            prefetcher.discard(filename)
+
+def diff_worker(t):
+    (args, old_filename, new_filename) = t
+    try:
+        return diff_rpyc(old_filename, new_filename, args.clobber, decompile_python=args.decompile_python,
+                         translator=load_translator(args), tag_outside_block=args.tag_outside_block,
+                         init_offset=args.init_offset, try_harder=args.try_harder)
+    except Exception as e:
+        with printlock:
+            print("Error while diffing %s:" % new_filename)
+            print(traceback.format_exc())
+        return False
+
+def script_files(directory):
+    # Paths of all script files in directory or its subdirectories
+    for dirpath, dirnames, filenames in walk(directory):
+        for j in filenames:
+            if len(j) >= 5 and j.endswith(('.rpyc', '.rpymc', '.rpypig')):
+                yield path.join(dirpath, j)
 
 def main():
     # python27 unrpyc.py [-c] [-d] [--python-screens|--ast-screens|--no-screens] file [file ...]
@@ -312,15 +711,43 @@ def main():
                         "This is always safe to enable if the game's Ren'Py version supports init offset statements, "
                         "and the generated code is exactly equivalent, only less cluttered.")
 
-    parser.add_argument('file', type=str, nargs='+',
+    parser.add_argument('file', type=str, nargs='*',
                         help="The filenames to decompile. "
                         "All .rpyc files in any directories passed or their subdirectories will also be decompiled.")
 
     parser.add_argument('--try-harder', dest="try_harder", action="store_true",
                         help="Tries some workarounds against common obfuscation methods. This is a lot slower.")
 
+    parser.add_argument('--try-harder-jobs', dest="try_harder_jobs", type=int, action="store", default=1,
+                        help="Only for --try-harder, the amount of processes used to try the workarounds on a single file. "
+                        "This speeds up very large obfuscated files, smaller files are still handled by a single process.")
+
+    parser.add_argument('--diff', dest='diff', nargs=2, metavar=('OLD', 'NEW'), default=None,
+                        help="Compare two builds of the same game and only decompile the top-level blocks "
+                        "(labels, screens, init blocks, ...) of NEW that changed since OLD. "
+                        "Output is written next to each script file of NEW with a .rpydiff extension.")
+
+    parser.add_argument('--diff-cache', dest='diff_cache', action='store', default=None,
+                        help="Only for --diff, remember the hashes of every script file in the specified file. "
+                        "Files of OLD that were hashed before, like the NEW build of the previous comparison, "
+                        "then don't have to be loaded again.")
+
+    parser.add_argument('--prefetch', dest='prefetch', type=int, action='store', default=4,
+                        help="The amount of files to read ahead in the background while decompiling. "
+                        "Use 0 to disable prefetching.")
+
+    parser.add_argument('--prefetch-memory', dest='prefetch_memory', type=int, action='store', default=256,
+                        help="The maximum amount of memory in MB used for files that have been read ahead.")
+
     args = parser.parse_args()
 
+    if not args.file and not args.diff:
+        parser.error("no files to decompile were given")
+
+    if args.try_harder and args.try_harder_jobs > 1:
+        # This has to happen before any threads are started, as the workers are forked from here
+        deobfuscate.start_pool(args.try_harder_jobs)
+
     if args.write_translation_file and not args.clobber and path.exists(args.write_translation_file):
         # Fail early to avoid wasting time going through the files
         print("Output translation file already exists. Pass --clobber to overwrite.")
@@ -329,6 +756,35 @@ def main():
     if args.translation_file:
         with open(args.translation_file, 'rb') as in_file:
             args.translations = in_file.read()
+
+    if args.diff:
+        old_dir, new_dir = args.diff
+        for directory in args.diff:
+            if not path.isdir(directory):
+                print("Not a directory: " + directory)
+                return
+
+        # set is shadowed by the fake class above
+        old_files = frozenset(path.relpath(i, old_dir) for i in script_files(old_dir))
+        new_files = list(sorted((path.relpath(i, new_dir) for i in script_files(new_dir)), reverse=True))
+        for i in sorted(old_files.difference(new_files)):
+            print("Removed %s" % path.join(old_dir, i))
+
+        if len(new_files) == 0:
+            print("No script files to diff.")
+            return
+
+        if args.diff_cache and path.exists(args.diff_cache):
+            read_block_cache(args.diff_cache)
+
+        results = list(map(diff_worker, [(args, path.join(old_dir, i) if i in old_files else None, path.join(new_dir, i))
+                                         for i in new_files]))
+
+        if args.diff_cache:
+            write_block_cache(args.diff_cache)
+        report(results.count(True), results.count(False))
+        return
+
     # Expand wildcards
     def glob_or_complain(s):
         retval = glob.glob(s)
@@ -346,8 +802,7 @@ def main():
     files = []
     for i in filesAndDirs:
         if path.isdir(i):
-            for dirpath, dirnames, filenames in walk(i):
-                files.extend(path.join(dirpath, j) for j in filenames if len(j) >= 5 and j.endswith(('.rpyc', '.rpymc', '.rpypig')))
+            files.extend(script_files(i))
         else:
             files.append(i)
 
@@ -361,7 +816,17 @@ def main():
 
     # Decompile in the order Ren'Py loads in
     files = list(sorted(files, key=itemgetter(1), reverse=True))
-    results = list(map(worker, files))
+
+    global prefetcher
+    if args.prefetch > 0:
+        prefetcher = Prefetcher([(filename, size) for (_, filename, size) in files],
+                                depth=args.prefetch, budget=args.prefetch_memory * 1024 * 1024)
+    try:
+        results = list(map(worker, files))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+            prefetcher = None
 
     if args.write_translation_file:
         print("Writing translations to %s..." % args.write_translation_file)
@@ -384,6 +849,9 @@ def main():
         good = results.count(True)
         bad = results.count(False)
 
+    report(good, bad)
+
+def report(good, bad):
     if bad == 0:
         print("Decompilation of %d script file%s successful" % (good, 's' if good>1 else ''))
     elif good == 0:
@@ -392,4 +860,7 @@ def main():
         print("Decompilation of %d file%s successful, but decompilation of %d file%s failed" % (good, 's' if good>1 else '', bad, 's' if bad>1 else ''))
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        deobfuscate.close_pool()